@@ -1,7 +1,9 @@
 """Streamlit chat UI. Run with: streamlit run app.py"""
 
 import os
+import threading
 import streamlit as st
+from data_loader import load_dataset
 from rag_pipeline import RAGPipeline
 
 st.set_page_config(page_title="Business Data Chat", page_icon="📊", layout="wide")
@@ -27,14 +29,28 @@ with st.sidebar:
 
 @st.cache_resource
 def get_pipeline(_api_key: str, _model: str) -> RAGPipeline:
-    return RAGPipeline(api_key=_api_key, model=_model)
+    # load_dataset is memoized per process, so every pipeline shares the same frames
+    dfs, schema = load_dataset()
+    return RAGPipeline(api_key=_api_key, model=_model, dfs=dfs, schema=schema)
 
 
+@st.cache_resource
+def warm_up() -> None:
+    # once per server process: load the tables in the background so the
+    # first question doesn't pay for it
+    threading.Thread(target=load_dataset, daemon=True).start()
+
+
+warm_up()
+
 st.title("📊 Business Data Chat")
 st.caption("Ask questions about clients, invoices, and line items.")
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "chat_history" not in st.session_state:
+    # completed question/answer turns, passed to the pipeline so follow-ups work
+    st.session_state.chat_history = []
 
 for msg in st.session_state.messages:
     with st.chat_message(msg["role"]):
@@ -54,28 +70,13 @@ if prompt := st.chat_input("Ask a question about the data..."):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # build history from prior turns so follow-ups work
-    chat_history = []
-    msgs = st.session_state.messages
-    i = 0
-    while i < len(msgs) - 1:
-        if msgs[i]["role"] == "user" and msgs[i + 1]["role"] == "assistant":
-            chat_history.append({
-                "question": msgs[i]["content"],
-                "answer": msgs[i + 1]["content"],
-                "code": msgs[i + 1].get("code", ""),
-                "data": msgs[i + 1].get("data", ""),
-            })
-            i += 2
-        else:
-            i += 1
-
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
             pipeline = get_pipeline(api_key, model)
-            result = pipeline.ask(prompt, history=chat_history)
+            result = pipeline.ask_stream(prompt, history=st.session_state.chat_history)
 
-        st.markdown(result["answer"])
+        # code has already run; the answer streams in as the LLM writes it
+        result["answer"] = st.write_stream(result["answer"])
 
         if result["error"]:
             st.error(f"Pipeline error: {result['error']}")
@@ -91,3 +92,10 @@ if prompt := st.chat_input("Ask a question about the data..."):
         "code": result.get("code", ""),
         "data": result.get("data", ""),
     })
+    st.session_state.chat_history.append({
+        "question": prompt,
+        "answer": result["answer"],
+        "code": result.get("code", ""),
+        # compact summary keeps follow-up prompts short; full data is only for display
+        "data": result.get("data_summary", ""),
+    })
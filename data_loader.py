@@ -1,19 +1,90 @@
 """Loads the Excel data and builds schema descriptions for the LLM."""
 
+import functools
 import os
+import tempfile
 import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_string_dtype
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
+# Dates are stored as ISO strings in the workbooks. Passing the format
+# explicitly skips pandas' per-value format inference.
+DATE_FORMAT = "%Y-%m-%d"
 
-def load_dataframes() -> dict[str, pd.DataFrame]:
-    """Load all three Excel files into DataFrames."""
-    clients = pd.read_excel(os.path.join(DATA_DIR, "Clients.xlsx"))
-    invoices = pd.read_excel(os.path.join(DATA_DIR, "Invoices.xlsx"))
-    line_items = pd.read_excel(os.path.join(DATA_DIR, "InvoiceLineItems.xlsx"))
 
-    invoices["invoice_date"] = pd.to_datetime(invoices["invoice_date"])
-    invoices["due_date"] = pd.to_datetime(invoices["due_date"])
+def _cached_read(path_xlsx: str, date_cols: tuple[str, ...] = ()) -> pd.DataFrame:
+    """Read an Excel file, using a sibling .parquet cache when it's up to date.
+
+    Columns use pyarrow-backed dtypes, so string columns (country,
+    service_name, ...) go through arrow compute kernels instead of Python
+    objects. Date columns are the exception: they're kept as numpy
+    datetime64 on both paths so `.dt` accessors like `to_period` work
+    regardless of whether the cache existed.
+    """
+    cache = os.path.splitext(path_xlsx)[0] + ".parquet"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path_xlsx):
+        try:
+            df = pd.read_parquet(cache, engine="pyarrow", dtype_backend="pyarrow")
+            return _to_numpy_dates(df, date_cols)
+        except Exception:
+            # corrupt/partial cache file, rebuild it from the Excel source
+            pass
+
+    df = pd.read_excel(path_xlsx, engine="openpyxl", dtype_backend="pyarrow")
+    for col in date_cols:
+        if not is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], format=DATE_FORMAT)
+    df = _to_numpy_dates(df, date_cols)
+    _write_cache(df, cache)
+    return df
+
+
+def _to_numpy_dates(df: pd.DataFrame, date_cols: tuple[str, ...]) -> pd.DataFrame:
+    for col in date_cols:
+        df[col] = df[col].astype("datetime64[ns]")
+    return df
+
+
+def _write_cache(df: pd.DataFrame, cache: str) -> None:
+    """Write the Parquet cache atomically so readers never see a partial file."""
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache), suffix=".parquet.tmp")
+    except OSError:
+        # read-only data dir, just skip caching
+        return
+    os.close(fd)
+    try:
+        df.to_parquet(tmp, engine="pyarrow", compression="zstd")
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _categorize(df: pd.DataFrame) -> None:
+    """Convert low-cardinality label columns (country, status, ...) to category.
+
+    Groupbys and joins on these then work on integer codes. ID columns
+    are left alone since they're (nearly) unique per row.
+    """
+    for col in df.columns:
+        if col.endswith("_id") or not is_string_dtype(df[col]):
+            continue
+        if df[col].nunique() <= len(df) // 2:
+            df[col] = df[col].astype("category")
+
+
+def load_dataframes() -> dict[str, pd.DataFrame]:
+    """Load all three Excel files into DataFrames (Parquet-cached)."""
+    clients = _cached_read(os.path.join(DATA_DIR, "Clients.xlsx"))
+    invoices = _cached_read(os.path.join(DATA_DIR, "Invoices.xlsx"),
+                            date_cols=("invoice_date", "due_date"))
+    line_items = _cached_read(os.path.join(DATA_DIR, "InvoiceLineItems.xlsx"))
+    for df in (clients, invoices, line_items):
+        _categorize(df)
 
     return {
         "clients": clients,
@@ -62,3 +133,14 @@ def get_schema_description(dfs: dict[str, pd.DataFrame]) -> str:
                  "general knowledge to classify the countries listed above.")
 
     return "\n".join(lines)
+
+
+@functools.lru_cache(maxsize=1)
+def load_dataset() -> tuple[dict[str, pd.DataFrame], str]:
+    """Load the tables and build their schema description, once per process.
+
+    Every pipeline then shares the same frames and a byte-identical schema
+    string (and so an identical system prompt).
+    """
+    dfs = load_dataframes()
+    return dfs, get_schema_description(dfs)
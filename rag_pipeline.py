@@ -1,15 +1,21 @@
 """RAG pipeline: generates pandas code from questions, executes it, synthesizes answers."""
 
+import ast
 import builtins
 import datetime
-import re
+import functools
+import hashlib
+import json
+import os
 import traceback
+from collections.abc import Iterator
+import diskcache
 import pandas as pd
 import numpy as np
 from dotenv import load_dotenv
 from groq import Groq
 
-from data_loader import load_dataframes, get_schema_description
+from data_loader import load_dataset
 
 # Builtins that are safe for generated code to use.
 _SAFE_BUILTINS = {
@@ -28,11 +34,98 @@ _SAFE_BUILTINS = {
     if hasattr(builtins, name)
 }
 
-# Regex that matches standalone import lines (import ... / from ... import ...)
-_IMPORT_RE = re.compile(r"^\s*(import |from \S+ import )", re.MULTILINE)
+# Bare names generated code may not reference. Attributes are checked
+# separately, so pandas' own `df.eval()` / `pd.eval()` stay usable.
+_FORBIDDEN_NAMES = {"__import__", "eval", "exec", "compile", "open", "globals", "locals", "vars"}
+
+
+class _CodeSanitizer(ast.NodeTransformer):
+    """Drops import statements and rejects references to unsafe names."""
+
+    def visit_Import(self, node):
+        return ast.Pass()
+
+    def visit_ImportFrom(self, node):
+        return ast.Pass()
+
+    def visit_Name(self, node):
+        if node.id in _FORBIDDEN_NAMES:
+            raise ValueError(f"Use of `{node.id}` is not allowed.")
+        if node.id in ("getattr", "hasattr"):
+            # only allowed as a direct call (checked in visit_Call), not aliased
+            raise ValueError(f"`{node.id}` may only be called directly.")
+        return node
+
+    def visit_Attribute(self, node):
+        # dunder attributes (__class__, __subclasses__, ...) are the usual sandbox escape
+        if node.attr.startswith("__"):
+            raise ValueError(f"Access to `.{node.attr}` is not allowed.")
+        return self.generic_visit(node)
+
+    def visit_Call(self, node):
+        # same check for getattr(obj, "__class__"); the name has to be a literal
+        if isinstance(node.func, ast.Name) and node.func.id in ("getattr", "hasattr"):
+            name = node.args[1] if len(node.args) > 1 else None
+            if not (isinstance(name, ast.Constant) and isinstance(name.value, str)):
+                raise ValueError(f"`{node.func.id}` needs a literal attribute name.")
+            if name.value.startswith("__"):
+                raise ValueError(f"Access to `.{name.value}` is not allowed.")
+            node.args = [self.visit(arg) for arg in node.args]
+            node.keywords = [self.visit(kw) for kw in node.keywords]
+            return node
+        return self.generic_visit(node)
+
+
+@functools.lru_cache(maxsize=512)
+def _compile(src: str):
+    """Compile sanitized source once; retries and repeat questions reuse the code object."""
+    return compile(src, "<generated>", "exec")
+
+
+ERROR_MAX_CHARS = 500
+
+
+def _format_error(exc: Exception, code: str) -> str:
+    """Short error summary for the retry prompt: the exception and the failing line.
+
+    A full traceback is mostly framework frames and file paths, which cost
+    tokens without helping the model fix its code.
+    """
+    msg = f"{type(exc).__name__}: {exc}"
+    lineno = None
+    if isinstance(exc, SyntaxError):
+        lineno = exc.lineno
+    else:
+        for frame in reversed(traceback.extract_tb(exc.__traceback__)):
+            if frame.filename == "<generated>":
+                lineno = frame.lineno
+                break
+    lines = code.splitlines()
+    if lineno and 0 < lineno <= len(lines):
+        msg += f"\n  at line {lineno}: {lines[lineno - 1].strip()}"
+    return msg[:ERROR_MAX_CHARS]
+
 
 load_dotenv()
 
+# With copy-on-write, shallow copies share data until someone writes to them,
+# so handing each exec its own frames costs nothing unless the code mutates.
+# It's the default (and the option deprecated) from pandas 3.0 on.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".rag_cache")
+# Bump when the way answers are produced changes, so old cached responses
+# aren't served (prompt template edits are picked up automatically).
+CACHE_VERSION = 3
+
+FAILED_ANSWER = "Sorry, I couldn't retrieve the data. Try rephrasing your question."
+
+# Semantic cache: paraphrased questions above this cosine similarity reuse
+# the cached response.
+SEMANTIC_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_THRESHOLD = 0.93
+
 # --- Prompt templates ---
 
 CODE_GEN_SYSTEM = """\
@@ -53,6 +146,9 @@ Key rules:
 - Line total including tax = quantity * unit_price * (1 + tax_rate).
 - Do NOT use print().
 - If the question asks to "list" something, make result a DataFrame.
+- Columns with dtype `category`: pass observed=True to groupby. They only \
+accept existing categories, so call .astype(str) before assigning or \
+filling (fillna) new values.
 
 If conversation history is provided and the user refers to a previous answer \
 ("which of those", "from them", etc.), use the prior context to understand \
@@ -72,16 +168,206 @@ If there's conversation history, use it to understand follow-up references.
 """
 
 
+PREVIEW_MAX_ROWS = 200
+PREVIEW_MAX_COLS = 20
+
+
+def _df_to_preview(df: pd.DataFrame, max_rows: int = PREVIEW_MAX_ROWS) -> str:
+    """Render a DataFrame as text, keeping only the head and tail if it's large."""
+    if len(df) <= max_rows:
+        return df.to_string(index=False, max_cols=PREVIEW_MAX_COLS)
+
+    half = max_rows // 2
+    lines = pd.concat([df.head(half), df.tail(half)]).to_string(
+        index=False, max_cols=PREVIEW_MAX_COLS,
+    ).split("\n")
+    # the header can span several lines (MultiIndex or named columns),
+    # so count it from the end: everything that isn't one of the rows
+    header_lines = len(lines) - 2 * half
+    lines.insert(header_lines + half, f"... {len(df) - max_rows} more rows ...")
+    return "\n".join(lines)
+
+
+HISTORY_DATA_LINES = 4
+
+
+def _compact_data(data_str: str, max_lines: int = HISTORY_DATA_LINES) -> str:
+    """Short version of a result for conversation history: header plus a few rows.
+
+    The previous turn's code is in the history too, so the model doesn't
+    need the full output to resolve follow-ups.
+    """
+    lines = data_str.splitlines()
+    if len(lines) <= max_lines:
+        return data_str
+    return "\n".join(lines[:max_lines]) + f"\n... ({len(lines) - max_lines} more lines)"
+
+
+def _is_small_result(result: object) -> bool:
+    """Scalars and single-row frames don't need an LLM call to be phrased."""
+    if isinstance(result, pd.DataFrame):
+        return len(result) <= 1
+    return isinstance(result, (int, float, str, np.generic))
+
+
+# Column names that mark a value as a currency amount (two decimals).
+_MONEY_HINTS = ("amount", "total", "revenue", "price", "billed", "paid", "cost")
+
+
+def _is_money_column(name: object) -> bool:
+    return any(hint in str(name).lower() for hint in _MONEY_HINTS)
+
+
+def _format_value(value: object, money: bool = False) -> str:
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        # pd.Timestamp is a datetime subclass; show plain dates without 00:00:00
+        return str(value.date())
+    if isinstance(value, (float, np.floating)):
+        if money:
+            return f"{value:,.2f}"
+        # keep precision for rates etc. (0.0725), just drop float noise
+        return f"{round(float(value), 6):,}"
+    if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return f"{value:,}"
+    return str(value)
+
+
+def _format_small_result(result: object) -> str:
+    """Format a scalar or single-row DataFrame as a markdown answer."""
+    if isinstance(result, pd.DataFrame):
+        if result.empty:
+            return "No matching data was found."
+        row = result.iloc[0]
+        header = "| " + " | ".join(str(c) for c in result.columns) + " |"
+        sep = "|" + "---|" * len(result.columns)
+        values = "| " + " | ".join(
+            _format_value(v, money=_is_money_column(c)) for c, v in row.items()
+        ) + " |"
+        return "\n".join([header, sep, values])
+    if isinstance(result, str):
+        return result
+    return f"**{_format_value(result)}**"
+
+
+def _response(answer: str | Iterator[str], code: str, data_str: str,
+              error: str | None = None) -> dict:
+    """The dict returned by `ask`/`ask_stream`."""
+    return {"answer": answer, "code": code, "data": data_str,
+            "data_summary": _compact_data(data_str), "error": error}
+
+
+def _normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
 class RAGPipeline:
-    def __init__(self, api_key: str, model: str = "llama-3.3-70b-versatile"):
-        self.client = Groq(api_key=api_key)
+    def __init__(self, api_key: str, model: str = "llama-3.3-70b-versatile",
+                 cache_dir: str | None = CACHE_DIR, semantic_cache: bool = False,
+                 dfs: dict[str, pd.DataFrame] | None = None, schema: str | None = None,
+                 api_retries: int = 2):
+        """`dfs` and `schema` can be passed in pre-loaded to share them across pipelines.
+
+        Pass `cache_dir=None` to disable response caching. `api_retries` is
+        how often the Groq client retries failed/rate-limited (429) requests,
+        with backoff.
+        """
+        if semantic_cache and cache_dir is None:
+            raise ValueError("semantic_cache requires a cache_dir")
+
+        self.client = Groq(api_key=api_key, max_retries=api_retries)
         self.model = model
-        self.dfs = load_dataframes()
-        self.schema = get_schema_description(self.dfs)
+        if dfs is None or schema is None:
+            dfs, schema = load_dataset()
+        self.dfs = dfs
+        self.schema = schema
+        # schema never changes after init, so format the system prompt once
+        self._code_system = CODE_GEN_SYSTEM.format(schema=self.schema)
+        # the schema only samples the data, so hash the actual contents too;
+        # otherwise editing a cell in the .xlsx would keep old answers cached
+        self._data_fp = hashlib.blake2b(json.dumps([
+            int(pd.util.hash_pandas_object(self.dfs[name]).sum())
+            for name in sorted(self.dfs)
+        ]).encode()).hexdigest()
+        self.cache_dir = cache_dir
+        self.cache = diskcache.Cache(cache_dir) if cache_dir is not None else None
+
+        self.encoder = None
+        if semantic_cache:
+            # heavy optional dependency, only pulled in when asked for
+            from sentence_transformers import SentenceTransformer
+            self.encoder = SentenceTransformer(SEMANTIC_MODEL)
+            self._load_semantic_index()
+
+    def _context_fingerprint(self, history: list[dict]) -> str:
+        """Hash of everything besides the question that determines the answer."""
+        prompts = self._code_system + ANSWER_GEN_SYSTEM  # includes the schema
+        payload = json.dumps([
+            CACHE_VERSION,
+            self.model,
+            hashlib.blake2b(prompts.encode()).hexdigest(),
+            self._data_fp,
+            [(h["question"], h["answer"]) for h in history],
+        ], sort_keys=True)
+        return hashlib.blake2b(payload.encode()).hexdigest()
+
+    @staticmethod
+    def _cache_key(question: str, context_fp: str) -> str:
+        payload = json.dumps([context_fp, _normalize_question(question)])
+        return hashlib.blake2b(payload.encode()).hexdigest()
+
+    # --- semantic cache ---
+
+    def _semantic_paths(self) -> tuple[str, str]:
+        return (os.path.join(self.cache_dir, "semantic_vecs.npy"),
+                os.path.join(self.cache_dir, "semantic_keys.json"))
+
+    def _load_semantic_index(self) -> None:
+        vecs_path, keys_path = self._semantic_paths()
+        if os.path.exists(vecs_path) and os.path.exists(keys_path):
+            self._sem_vecs = np.load(vecs_path)
+            with open(keys_path) as f:
+                self._sem_entries = json.load(f)  # [[context_fp, key], ...]
+        else:
+            dim = self.encoder.get_sentence_embedding_dimension()
+            self._sem_vecs = np.empty((0, dim), dtype=np.float32)
+            self._sem_entries = []
+
+    def _save_semantic_index(self) -> None:
+        vecs_path, keys_path = self._semantic_paths()
+        np.save(vecs_path, self._sem_vecs)
+        with open(keys_path, "w") as f:
+            json.dump(self._sem_entries, f)
+
+    def _semantic_lookup(self, q_vec: np.ndarray, context_fp: str) -> dict | None:
+        """Return the cached response for the most similar prior question, if close enough."""
+        if not self._sem_entries:
+            return None
+        sims = self._sem_vecs @ q_vec
+        # only consider questions asked in the same context (model/schema/history)
+        same_ctx = np.array([fp == context_fp for fp, _ in self._sem_entries])
+        sims = np.where(same_ctx, sims, -1.0)
+        i = int(np.argmax(sims))
+        if sims[i] > SEMANTIC_THRESHOLD:
+            return self.cache.get(self._sem_entries[i][1])
+        return None
+
+    def _semantic_add(self, q_vec: np.ndarray, context_fp: str, key: str) -> None:
+        self._sem_vecs = np.vstack([self._sem_vecs, q_vec[None, :]])
+        self._sem_entries.append([context_fp, key])
+        self._save_semantic_index()
+
+    def clear_cache(self) -> None:
+        """Drop all cached responses."""
+        if self.cache is None:
+            return
+        self.cache.clear()
+        if self.encoder is not None:
+            self._sem_vecs = self._sem_vecs[:0]
+            self._sem_entries = []
+            self._save_semantic_index()
 
     def _generate_code(self, question: str, history: list[dict] | None = None) -> str:
-        system = CODE_GEN_SYSTEM.format(schema=self.schema)
-        messages = [{"role": "system", "content": system}]
+        messages = [{"role": "system", "content": self._code_system}]
 
         for turn in history or []:
             messages.append({"role": "user", "content": turn["question"]})
@@ -108,34 +394,45 @@ class RAGPipeline:
         return code
 
     @staticmethod
+    @functools.lru_cache(maxsize=512)
     def _sanitize_code(code: str) -> str:
-        """Remove import statements from generated code.
+        """Remove import statements from generated code and reject unsafe names.
 
         All required libraries (pd, np, datetime, etc.) are already
         provided in the execution namespace, so imports are unnecessary
-        and would fail in the sandboxed exec.
+        and would fail in the sandboxed exec. Parsing with `ast` also
+        catches imports nested in blocks and calls like `__import__("os")`
+        that a line-based strip would miss.
+
+        Returns the canonical (unparsed) source. Raises SyntaxError or
+        ValueError if the code can't be parsed or isn't allowed. Results are
+        memoized, so a snippet seen before skips parsing entirely.
         """
-        return _IMPORT_RE.sub("", code)
+        tree = _CodeSanitizer().visit(ast.parse(code))
+        return ast.unparse(tree)
 
     def _execute_code(self, code: str) -> tuple[object, str | None]:
         """Run generated code in a restricted namespace. Returns (result, error)."""
-        code = self._sanitize_code(code)
         ns = {
             "__builtins__": _SAFE_BUILTINS,
             "pd": pd, "np": np, "datetime": datetime,
-            "clients": self.dfs["clients"].copy(),
-            "invoices": self.dfs["invoices"].copy(),
-            "line_items": self.dfs["line_items"].copy(),
+            "clients": self.dfs["clients"].copy(deep=False),
+            "invoices": self.dfs["invoices"].copy(deep=False),
+            "line_items": self.dfs["line_items"].copy(deep=False),
         }
         try:
+            code = self._sanitize_code(code)
             # TODO: swap exec for something like RestrictedPython in production
-            exec(code, ns)
-            return ns.get("result", "No `result` variable was set."), None
-        except Exception:
-            return None, traceback.format_exc()
+            exec(_compile(code), ns)
+            if "result" not in ns:
+                return None, "NameError: the code did not set a `result` variable."
+            return ns["result"], None
+        except Exception as e:
+            return None, _format_error(e, code)
 
-    def _generate_answer(self, question: str, data_str: str,
-                         history: list[dict] | None = None) -> str:
+    @staticmethod
+    def _answer_messages(question: str, data_str: str,
+                         history: list[dict] | None = None) -> list[dict]:
         messages = [{"role": "system", "content": ANSWER_GEN_SYSTEM}]
 
         for turn in history or []:
@@ -146,18 +443,61 @@ class RAGPipeline:
             "role": "user",
             "content": f"**Question:** {question}\n\n**Retrieved data:**\n```\n{data_str}\n```",
         })
+        return messages
 
+    def _generate_answer(self, question: str, data_str: str,
+                         history: list[dict] | None = None) -> str:
         resp = self.client.chat.completions.create(
-            model=self.model, messages=messages, temperature=0, max_tokens=2048,
+            model=self.model, messages=self._answer_messages(question, data_str, history),
+            temperature=0, max_tokens=2048,
         )
         return resp.choices[0].message.content.strip()
 
-    def ask(self, question: str, history: list[dict] | None = None,
-            max_retries: int = 2) -> dict:
-        """Run the full pipeline: question -> code -> execute -> answer."""
-        history = history or []
+    def _stream_answer(self, question: str, data_str: str,
+                       history: list[dict] | None = None) -> Iterator[str]:
+        """Same as `_generate_answer`, but yields text chunks as they arrive."""
+        stream = self.client.chat.completions.create(
+            model=self.model, messages=self._answer_messages(question, data_str, history),
+            temperature=0, max_tokens=2048, stream=True,
+        )
+        for chunk in stream:
+            text = chunk.choices[0].delta.content
+            if text:
+                yield text
+
+    def _cache_lookup(self, question: str, history: list[dict]):
+        """Check the exact and semantic caches.
+
+        Returns (cached_response, key, context_fp, q_vec); the last three are
+        needed to store the response on a miss.
+        """
+        if self.cache is None:
+            return None, None, None, None
+        context_fp = self._context_fingerprint(history)
+        key = self._cache_key(question, context_fp)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached, key, context_fp, None
+
+        q_vec = None
+        if self.encoder is not None:
+            q_vec = self.encoder.encode([question], normalize_embeddings=True)[0]
+            cached = self._semantic_lookup(q_vec, context_fp)
+        return cached, key, context_fp, q_vec
+
+    def _cache_store(self, key: str, context_fp: str, q_vec: np.ndarray | None,
+                     response: dict) -> None:
+        if self.cache is None:
+            return
+        self.cache.set(key, response)
+        if q_vec is not None:
+            self._semantic_add(q_vec, context_fp, key)
+
+    def _retrieve(self, question: str, history: list[dict],
+                  max_retries: int) -> tuple[str, object, str, str | None]:
+        """Generate and run code, retrying on errors. Returns (code, result, data_str, error)."""
         last_error = None
-        code = data_str = ""
+        code = ""
 
         for _ in range(max_retries):
             if last_error is None:
@@ -175,16 +515,63 @@ class RAGPipeline:
                 continue
 
             if isinstance(result, pd.DataFrame):
-                data_str = result.to_string(index=False)
+                data_str = _df_to_preview(result)
             elif isinstance(result, pd.Series):
                 data_str = result.to_string()
             else:
                 data_str = str(result)
+            return code, result, data_str, None
+
+        return code, None, "", last_error
+
+    def ask(self, question: str, history: list[dict] | None = None,
+            max_retries: int = 2) -> dict:
+        """Run the full pipeline: question -> code -> execute -> answer."""
+        history = history or []
+        cached, key, context_fp, q_vec = self._cache_lookup(question, history)
+        if cached is not None:
+            return cached
 
+        code, result, data_str, error = self._retrieve(question, history, max_retries)
+        if error is not None:
+            return _response(FAILED_ANSWER, code, "", error)
+
+        if _is_small_result(result):
+            answer = _format_small_result(result)
+        else:
             answer = self._generate_answer(question, data_str, history=history)
-            return {"answer": answer, "code": code, "data": data_str, "error": None}
+        response = _response(answer, code, data_str)
+        self._cache_store(key, context_fp, q_vec, response)
+        return response
 
-        return {
-            "answer": "Sorry, I couldn't retrieve the data. Try rephrasing your question.",
-            "code": code, "data": "", "error": last_error,
-        }
+    def ask_stream(self, question: str, history: list[dict] | None = None,
+                   max_retries: int = 2) -> dict:
+        """Like `ask`, but `answer` is an iterator of text chunks.
+
+        Code generation and execution still happen up front; only the answer
+        synthesis is streamed. The response is cached once the stream is
+        fully consumed.
+        """
+        history = history or []
+        cached, key, context_fp, q_vec = self._cache_lookup(question, history)
+        if cached is not None:
+            return {**cached, "answer": iter([cached["answer"]])}
+
+        code, result, data_str, error = self._retrieve(question, history, max_retries)
+        if error is not None:
+            return _response(iter([FAILED_ANSWER]), code, "", error)
+
+        if _is_small_result(result):
+            response = _response(_format_small_result(result), code, data_str)
+            self._cache_store(key, context_fp, q_vec, response)
+            return {**response, "answer": iter([response["answer"]])}
+
+        def answer_chunks() -> Iterator[str]:
+            parts = []
+            for text in self._stream_answer(question, data_str, history=history):
+                parts.append(text)
+                yield text
+            self._cache_store(key, context_fp, q_vec,
+                              _response("".join(parts).strip(), code, data_str))
+
+        return _response(answer_chunks(), code, data_str)
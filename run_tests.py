@@ -2,11 +2,19 @@
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from rag_pipeline import RAGPipeline
 
 load_dotenv()
 
+# Questions are I/O-bound (two Groq calls each), so run them concurrently.
+# Kept modest to stay under Groq's rate limits.
+MAX_WORKERS = 8
+# Concurrent workers hit Groq's per-minute limits quickly; let the client
+# back off and retry 429s more than its default of 2 times.
+API_RETRIES = 8
+
 QUESTIONS = [
     "List all clients with their industries.",
     "Which clients are based in the UK?",
@@ -33,24 +41,32 @@ def main():
         print("Set GROQ_API_KEY in .env or environment.")
         sys.exit(1)
 
-    pipeline = RAGPipeline(api_key=api_key)
+    # no response cache: results should reflect the current code, not old runs
+    pipeline = RAGPipeline(api_key=api_key, cache_dir=None, api_retries=API_RETRIES)
+
+    answers = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {ex.submit(pipeline.ask, q): i for i, q in enumerate(QUESTIONS)}
+        for done, fut in enumerate(as_completed(futures), 1):
+            i = futures[fut]
+            try:
+                result = fut.result()
+            except Exception as e:
+                # e.g. still rate limited after retries; keep the other answers
+                answers[i] = f"ERROR: {e}"
+            else:
+                answers[i] = result["answer"] if not result["error"] else f"ERROR: {result['error']}"
+            print(f"[{done}/{len(QUESTIONS)}] done: {QUESTIONS[i]}")
 
-    rows = []
-    for i, q in enumerate(QUESTIONS, 1):
-        print(f"[{i}/{len(QUESTIONS)}] {q}")
-        result = pipeline.ask(q)
-        answer = result["answer"] if not result["error"] else f"ERROR: {result['error']}"
-        rows.append((q, answer))
-        print("  done\n")
+    buf = ["# Test Results\n\n", "| Question | Answer |\n", "|----------|--------|\n"]
+    # futures finish in any order; write rows back in question order
+    for i, q in enumerate(QUESTIONS):
+        a_esc = answers[i].replace("|", "\\|").replace("\n", "<br>")
+        q_esc = q.replace("|", "\\|")
+        buf.append(f"| {q_esc} | {a_esc} |\n")
 
     with open("test_results.md", "w") as f:
-        f.write("# Test Results\n\n")
-        f.write("| Question | Answer |\n")
-        f.write("|----------|--------|\n")
-        for q, a in rows:
-            a_esc = a.replace("|", "\\|").replace("\n", "<br>")
-            q_esc = q.replace("|", "\\|")
-            f.write(f"| {q_esc} | {a_esc} |\n")
+        f.write("".join(buf))
 
     print("Done -> test_results.md")
 